@@ -31,6 +31,7 @@ import numpy as np
 from compiler_opt.rl import env, log_reader
 from compiler_opt.rl import corpus
 from compiler_opt.rl import log_reader_test
+from compiler_opt.testing import popen_stub
 
 _CLANG_PATH = '/test/clang/path'
 
@@ -39,6 +40,7 @@ _MOCK_MODULE = corpus.LoadedModuleSpec(
     loaded_ir=b'asdf',
     orig_options=('--opt_a', 'a', '--opt_b', 'b'),
 )
+_MOCK_BASE_ARGS = list(_MOCK_MODULE.orig_options)
 
 _NUM_STEPS = 10
 
@@ -61,8 +63,49 @@ class MockTask(env.MLGOTask):
     return {'default': 47}
 
 
+class _MockInteractiveClangLog:
+  """Writes the log a mock interactive clang process would produce."""
+
+  def __init__(self, f_out: io.FileIO):
+    self._f_out = f_out
+    self._counter = 0
+    self._writer = log_reader_test.LogTestExampleBuilder(opened_file=f_out)
+    # Write the header describing the features/rewards
+    self._writer.write_header({
+        'features': [{
+            'name': 'times_called',
+            'port': 0,
+            'shape': [1],
+            'type': 'int64_t',
+        },],
+        'score': {
+            'name': 'reward',
+            'port': 0,
+            'shape': [1],
+            'type': 'float',
+        },
+    })
+    self._writer.write_newline()
+    self._writer.flush()
+
+  # We poll the process at every call to get_observation to ensure the
+  # clang process is still alive. So here, each time poll() is called,
+  # write a new context
+  def write_step(self):
+    if self._counter >= _NUM_STEPS:
+      self._f_out.close()
+      return
+    self._writer.write_context_marker(f'context_{self._counter}')
+    self._writer.write_observation(
+        0,
+        tensors=[([self._counter], ctypes.c_int64)],
+        outcome=[3.14],
+        outcome_ct=ctypes.c_float)
+    self._writer.flush()
+    self._counter += 1
+
+
 # This mocks subprocess.Popen for interactive clang sessions
-@contextlib.contextmanager
 def mock_interactive_clang(cmdline, stderr, stdout):
   del stderr
   del stdout
@@ -73,66 +116,21 @@ def mock_interactive_clang(cmdline, stderr, stdout):
       fname = arg[len('--interactive='):]
       break
 
-  class MockProcess:
-
-    def wait(self, timeout):
-      pass
-
-    def kill(self):
-      pass
-
   if not fname:
-    yield MockProcess()
-    return
-  # Create the fds for the pipes
-  # (the env doesn't create the files, it assumes they are opened by clang)
-  with io.FileIO(fname + '.out', 'wb+') as f_out:
-    with io.FileIO(fname + '.in', 'rb+') as f_in:
-      del f_in
-      writer = log_reader_test.LogTestExampleBuilder(opened_file=f_out)
-      # Write the header describing the features/rewards
-      writer.write_header({
-          'features': [{
-              'name': 'times_called',
-              'port': 0,
-              'shape': [1],
-              'type': 'int64_t',
-          },],
-          'score': {
-              'name': 'reward',
-              'port': 0,
-              'shape': [1],
-              'type': 'float',
-          },
-      })
-      writer.write_newline()
-
-      class MockInteractiveProcess(MockProcess):
-        """Mock clang interactive process that writes the log."""
-
-        def __init__(self):
-          self._counter = 0
-
-        # We poll the process at every call to get_observation to ensure the
-        # clang process is still alive. So here, each time poll() is called,
-        # write a new context
-        def poll(self):
-          if self._counter >= _NUM_STEPS:
-            f_out.close()
-            return None
-          example_writer = log_reader_test.LogTestExampleBuilder(
-              opened_file=f_out)
-          example_writer.write_context_marker(f'context_{self._counter}')
-          example_writer.write_observation_marker(0)
-          example_writer.write_buff([self._counter], ctypes.c_int64)
-          example_writer.write_newline()
-          example_writer.write_outcome_marker(0)
-          example_writer.write_buff([3.14], ctypes.c_float)
-          example_writer.write_newline()
-          self._counter += 1
-          return None
-
-      yield MockInteractiveProcess()
+    return popen_stub.PopenStub()
+  # Open our ends of the pipes. The env already created both as fifos and opens
+  # them by path, expecting clang to open the other end. Being fifos, nothing
+  # written here touches the disk, so there's no need for an in-memory file.
+  # The '.in' end must stay open for the whole session: it unblocks the env's
+  # open of its writer and keeps the actions it sends from hitting a broken
+  # pipe.
+  with contextlib.ExitStack() as pipes:
+    f_out = pipes.enter_context(io.FileIO(fname + '.out', 'wb+'))
+    pipes.enter_context(io.FileIO(fname + '.in', 'rb+'))
+    log = _MockInteractiveClangLog(f_out)
+    # Hand the open pipes over to the stub, which closes them on exit.
+    return popen_stub.PopenStub(
+        on_poll=log.write_step, on_exit=pipes.pop_all().close)
 
 
 class ClangSessionTest(tf.test.TestCase):
@@ -141,11 +139,8 @@ class ClangSessionTest(tf.test.TestCase):
   def test_clang_session(self, mock_popen):
     mock_task = MockTask()
     with env.clang_session(
-        _CLANG_PATH, _MOCK_MODULE, MockTask,
-        interactive=False) as clang_session:
-      del clang_session
-      cmdline = mock_task.get_cmdline(_CLANG_PATH,
-                                      list(_MOCK_MODULE.orig_options), None,
+        _CLANG_PATH, _MOCK_MODULE, MockTask, interactive=False):
+      cmdline = mock_task.get_cmdline(_CLANG_PATH, _MOCK_BASE_ARGS, None,
                                       '/tmp/mock/tmp/file')
       mock_popen.assert_called_once_with(
           cmdline, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
@@ -158,10 +153,7 @@ class ClangSessionTest(tf.test.TestCase):
         _CLANG_PATH, _MOCK_MODULE, MockTask, interactive=True) as clang_session:
       for idx in range(_NUM_STEPS):
         obs = clang_session.get_observation()
-        self.assertEqual(
-            obs.obs['times_called'],
-            np.array([idx], dtype=np.int64),
-        )
+        self.assertAllEqual(obs.obs['times_called'], [idx])
         self.assertEqual(obs.context, f'context_{idx}')
       mock_popen.assert_called_once()
 
@@ -350,6 +342,7 @@ class PipelineCommsTest(parameterized.TestCase):
             w.write_context_marker('hello')
             w.write_observation_marker(0)
             w.write_buff([1], ctypes.c_int16)
+            w.flush()
             out.flush()
             wrote_event.set()
             time.sleep(3600)
@@ -407,6 +400,7 @@ class PipelineCommsTest(parameterized.TestCase):
             w.write_outcome_marker(0)
             w.write_buff([3.14], ctypes.c_float)
             w.write_newline()
+            w.flush()
             out.flush()
             wrote_event.set()
             time.sleep(3600)
@@ -444,13 +438,11 @@ class MLGOEnvironmentTest(tf.test.TestCase):
         action_spec={},
     )
 
-    for env_itr in range(3):
-      del env_itr
+    for _ in range(3):
       step = test_env.reset(_MOCK_MODULE)
       self.assertEqual(step.step_type, env.StepType.FIRST)
 
-      for step_itr in range(_NUM_STEPS - 1):
-        del step_itr
+      for _ in range(_NUM_STEPS - 1):
         step = test_env.step(np.array([1], dtype=np.int64))
         self.assertEqual(step.step_type, env.StepType.MID)
 
@@ -470,13 +462,11 @@ class MLGOEnvironmentTest(tf.test.TestCase):
         interactive_only=True,
     )
 
-    for env_itr in range(3):
-      del env_itr
+    for _ in range(3):
       step = test_env.reset(_MOCK_MODULE)
       self.assertEqual(step.step_type, env.StepType.FIRST)
 
-      for step_itr in range(_NUM_STEPS - 1):
-        del step_itr
+      for _ in range(_NUM_STEPS - 1):
         step = test_env.step(np.array([1], dtype=np.int64))
         self.assertEqual(step.step_type, env.StepType.MID)
 
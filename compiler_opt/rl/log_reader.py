@@ -57,6 +57,7 @@ which is used there for testing.
 import collections
 import ctypes
 import dataclasses
+import functools
 import json
 import math
 
@@ -76,9 +77,15 @@ _dtype_to_ctype = {
 
 
 def create_tensorspec(d: dict[str, Any]) -> tf.TensorSpec:
-  name: str = d['name']
-  shape: list[int] = [int(e) for e in d['shape']]
-  element_type_str: str = d['type']
+  # Every log re-declares its features, and there are only a handful of
+  # distinct ones, so normalize the dict into a hashable key and memoize.
+  return _create_tensorspec(d['name'], tuple(int(e) for e in d['shape']),
+                            d['type'])
+
+
+@functools.lru_cache(maxsize=128)
+def _create_tensorspec(name: str, shape: tuple[int, ...],
+                       element_type_str: str) -> tf.TensorSpec:
   if element_type_str not in _element_type_name_to_dtype:
     raise ValueError(f'uknown type: {element_type_str}')
   return tf.TensorSpec(
@@ -235,18 +242,24 @@ def _add_feature(se: tf.train.SequenceExample, spec: tf.TensorSpec,
   lst.extend(value)
 
 
-def read_log_as_sequence_examples(
-    fname: str) -> dict[str, tf.train.SequenceExample]:
+def read_log_as_sequence_examples_from_file(
+    f: BinaryIO) -> dict[str, tf.train.SequenceExample]:
   ret: dict[str, tf.train.SequenceExample] = collections.defaultdict(
       tf.train.SequenceExample)
   # a record is an observation: the features and score for one step.
   # the records are in time order
   # the `context` is, for example, the function name for passes like regalloc.
   # we produce a dictionary keyed in contexts with SequenceExample values.
-  for record in read_log(fname):
+  for record in read_log_from_file(f):
     se = ret[record.context]
     if record.score:
       _add_feature(se, record.score.spec, record.score)
     for t in record.feature_values:
       _add_feature(se, t.spec, t)
   return ret
+
+
+def read_log_as_sequence_examples(
+    fname: str) -> dict[str, tf.train.SequenceExample]:
+  with open(fname, 'rb') as f:
+    return read_log_as_sequence_examples_from_file(f)
@@ -15,14 +15,18 @@
 
 import ctypes
 import enum
+import functools
+import io
 import json
+from absl.testing import parameterized
 from compiler_opt.rl import log_reader
 
 # This is https://github.com/google/pytype/issues/764
 from google.protobuf import text_format  # pytype: disable=pyi-error
-from typing import BinaryIO
+from typing import Any, BinaryIO
 
 import numpy as np
+import numpy.typing as npt
 import tensorflow as tf
 
 
@@ -30,8 +34,16 @@ def json_to_bytes(d) -> bytes:
   return json.dumps(d).encode('utf-8')
 
 
+@functools.lru_cache(maxsize=256)
+def _context_marker_bytes(name: str) -> bytes:
+  return json_to_bytes({'context': name})
+
+
 class LogTestExampleBuilder:
-  """Construct a log."""
+  """Construct a log.
+
+  Writes are staged in memory and only reach `opened_file` on `flush()`.
+  """
 
   newline = b'\n'
   error_newline = b'hi there'
@@ -54,45 +66,95 @@ class LogTestExampleBuilder:
   ):
     self._opened_file = opened_file
     self._introduce_error_pos = introduce_error_pos
-
-  def write_buff(self, buffer: list, ct):
-    # we should get the ctypes array to bytes for pytype to be happy.
+    self._buf = io.BytesIO()
+    # Pick the newline logic once: without an error to inject, every newline
+    # is a real one and there's no position to compare against.
+    if introduce_error_pos == self.ErrorMarkers.NONE:
+      self._newline_bytes = lambda position=None: self.newline
+    else:
+      self._newline_bytes = lambda position=None: (
+          self.error_newline
+          if position == introduce_error_pos else self.newline)
+
+  def _buff_bytes(self, buffer: npt.ArrayLike, ct) -> bytes:
+    # numpy accepts the ctypes type as a dtype, and packs the whole buffer
+    # in one go.
+    arr = np.asarray(buffer, dtype=ct)
     if self._introduce_error_pos == self.ErrorMarkers.TENSOR_BUF_POS:
-      buffer = buffer[len(buffer) // 2:]
-    # pytype:disable=wrong-arg-types
-    self._opened_file.write((ct * len(buffer))(*buffer))
-    # pytype:enable=wrong-arg-types
+      arr = arr[len(arr) // 2:]
+    return arr.tobytes()
+
+  def _observation_marker_bytes(self, obs_idx: int) -> bytes:
+    # Same bytes as json_to_bytes({'observation': obs_idx}), without going
+    # through the json encoder.
+    return (f'{{"observation": {obs_idx}}}'.encode() +
+            self._newline_bytes(self.ErrorMarkers.OBS_MARKER_POS))
+
+  def _outcome_marker_bytes(self, obs_idx: int) -> bytes:
+    return (f'{{"outcome": {obs_idx}}}'.encode() +
+            self._newline_bytes(self.ErrorMarkers.OUTCOME_MARKER_POS))
+
+  def write_buff(self, buffer: npt.ArrayLike, ct):
+    self._buf.write(self._buff_bytes(buffer, ct))
 
   def write_newline(self, position=None):
-    self._opened_file.write(self.error_newline if position ==
-                            self._introduce_error_pos else self.newline)
+    self._buf.write(self._newline_bytes(position))
 
   def write_context_marker(self, name: str):
-    self._opened_file.write(json_to_bytes({'context': name}))
+    self._buf.write(_context_marker_bytes(name))
     self.write_newline(self.ErrorMarkers.CTX_MARKER_POS)
 
   def write_observation_marker(self, obs_idx: int):
-    self._opened_file.write(json_to_bytes({'observation': obs_idx}))
-    self.write_newline(self.ErrorMarkers.OBS_MARKER_POS)
+    self._buf.write(self._observation_marker_bytes(obs_idx))
 
   def write_outcome_marker(self, obs_idx: int):
-    self._opened_file.write(json_to_bytes({'outcome': obs_idx}))
-    self.write_newline(self.ErrorMarkers.OUTCOME_MARKER_POS)
-
-  def write_header(self, json_header: dict):
-    self._opened_file.write(json_to_bytes(json_header))
-
+    self._buf.write(self._outcome_marker_bytes(obs_idx))
 
-def create_example(fname: str,
-                   *,
-                   nr_contexts=1,
-                   introduce_errors_pos: LogTestExampleBuilder
-                   .ErrorMarkers = LogTestExampleBuilder.ErrorMarkers.NONE):
-  t0_val = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]
-  t1_val = [1, 2, 3]
-  s = [1.2]
+  def write_observation(
+      self,
+      obs_idx: int,
+      tensors: list[tuple[npt.ArrayLike, Any]],
+      outcome: npt.ArrayLike,
+      outcome_ct,
+  ):
+    """Write an observation and its outcome with a single write.
+
+    Args:
+      obs_idx: the observation (and outcome) id.
+      tensors: (buffer, ctype) pairs for the features, in header order.
+      outcome: the outcome buffer.
+      outcome_ct: the ctype of the outcome buffer.
+    """
+    self._buf.write(b''.join([
+        self._observation_marker_bytes(obs_idx),
+        *(self._buff_bytes(buffer, ct) for buffer, ct in tensors),
+        self._newline_bytes(self.ErrorMarkers.TENSORS_POS),
+        self._outcome_marker_bytes(obs_idx),
+        self._buff_bytes(outcome, outcome_ct),
+        self._newline_bytes(self.ErrorMarkers.OUTCOME_POS),
+    ]))
 
-  with open(fname, 'wb') as f:
+  def write_header(self, json_header: dict):
+    self._buf.write(json_to_bytes(json_header))
+
+  def flush(self):
+    """Write everything staged so far to the file in a single call."""
+    self._opened_file.write(self._buf.getvalue())
+    self._buf.seek(0)
+    self._buf.truncate()
+
+
+def create_example_bytes(
+    *,
+    nr_contexts=1,
+    introduce_errors_pos: LogTestExampleBuilder
+    .ErrorMarkers = LogTestExampleBuilder.ErrorMarkers.NONE
+) -> bytes:
+  t0_val = np.array([0.1, 0.2, 0.3, 0.4, 0.5, 0.6], dtype=np.float32)
+  t1_val = np.array([1, 2, 3], dtype=np.int64)
+  s = np.array([1.2], dtype=np.float32)
+
+  with io.BytesIO() as f:
     example_writer = LogTestExampleBuilder(
         opened_file=f, introduce_error_pos=introduce_errors_pos)
     example_writer.write_header({
@@ -116,102 +178,43 @@ def create_example(fname: str,
     })
     example_writer.write_newline(
         LogTestExampleBuilder.ErrorMarkers.AFTER_HEADER)
+    example_writer.flush()
     for ctx_id in range(nr_contexts):
-      t0_val = [v + ctx_id * 10 for v in t0_val]
-      t1_val = [v + ctx_id * 10 for v in t1_val]
+      t0_val += ctx_id * 10
+      t1_val += ctx_id * 10
       example_writer.write_context_marker(f'context_nr_{ctx_id}')
 
       def write_example_obs(obs: int):
-        example_writer.write_observation_marker(obs)
-        example_writer.write_buff(t0_val, ctypes.c_float)
-        example_writer.write_buff(t1_val, ctypes.c_int64)
-        example_writer.write_newline(
-            LogTestExampleBuilder.ErrorMarkers.TENSORS_POS)
-        example_writer.write_outcome_marker(obs)
-        example_writer.write_buff(s, ctypes.c_float)
-        example_writer.write_newline(
-            LogTestExampleBuilder.ErrorMarkers.OUTCOME_POS)
+        example_writer.write_observation(
+            obs,
+            tensors=[(t0_val, ctypes.c_float), (t1_val, ctypes.c_int64)],
+            outcome=s,
+            outcome_ct=ctypes.c_float)
 
       write_example_obs(0)
-      t0_val = [v + 1 for v in t0_val]
-      t1_val = [v + 1 for v in t1_val]
-      s[0] += 1
+      t0_val += 1
+      t1_val += 1
+      s += 1
       write_example_obs(1)
+      example_writer.flush()
+    return f.getvalue()
 
 
-class LogReaderTest(tf.test.TestCase):
-
-  def test_create_tensorspec(self):
-    ts = log_reader.create_tensorspec({
-        'name': 'tensor_name',
-        'port': 0,
-        'shape': [2, 3],
-        'type': 'float'
-    })
-    self.assertEqual(
-        ts, tf.TensorSpec(name='tensor_name', shape=[2, 3], dtype=tf.float32))
-
-  def test_read_header(self):
-    logfile = self.create_tempfile()
-    create_example(logfile)
-    with open(logfile, 'rb') as f:
-      header = log_reader._read_header(f)  # pylint: disable=protected-access
-      self.assertIsNotNone(header)
-      # Disable attribute error because header is an Optional type, and pytype
-      # on python 3.9 doesn't recognise that we already checked the Optional is
-      # not None
-      # pytype: disable=attribute-error
-      self.assertEqual(header.features, [
-          tf.TensorSpec(name='tensor_name2', shape=[2, 3], dtype=tf.float32),
-          tf.TensorSpec(name='tensor_name1', shape=[3, 1], dtype=tf.int64)
-      ])
-      self.assertEqual(
-          header.score,
-          tf.TensorSpec(name='reward', shape=[1], dtype=tf.float32))
-      # pytype: enable=attribute-error
-
-  def test_read_header_empty_file(self):
-    logfile = self.create_tempfile()
-    with open(logfile, 'rb') as f:
-      header = log_reader._read_header(f)  # pylint:disable=protected-access
-      self.assertIsNone(header)
-
-  def test_read_log(self):
-    logfile = self.create_tempfile()
-    create_example(logfile)
-    obs_id = 0
-    for record in log_reader.read_log(logfile):
-      self.assertEqual(record.observation_id, obs_id)
-      self.assertAlmostEqual(record.score[0], 1.2 + obs_id)
-      obs_id += 1
-    self.assertEqual(obs_id, 2)
+def create_example(fname: str,
+                   *,
+                   nr_contexts=1,
+                   introduce_errors_pos: LogTestExampleBuilder
+                   .ErrorMarkers = LogTestExampleBuilder.ErrorMarkers.NONE):
+  with open(fname, 'wb') as f:
+    f.write(
+        create_example_bytes(
+            nr_contexts=nr_contexts, introduce_errors_pos=introduce_errors_pos))
 
-  def test_to_numpy(self):
-    logfile = self.create_tempfile()
-    create_example(logfile)
-    t0_val = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]
-    t1_val = [1, 2, 3]
-    for record in log_reader.read_log(logfile):
-      np.testing.assert_allclose(record.feature_values[0].to_numpy(),
-                                 np.array(t0_val))
-      np.testing.assert_allclose(record.feature_values[1].to_numpy(),
-                                 np.array(t1_val))
-      t0_val = [v + 1 for v in t0_val]
-      t1_val = [v + 1 for v in t1_val]
 
-  def test_seq_example_conversion(self):
-    logfile = self.create_tempfile()
-    create_example(logfile, nr_contexts=2)
-    seq_examples = log_reader.read_log_as_sequence_examples(logfile)
-    self.assertIn('context_nr_0', seq_examples)
-    self.assertIn('context_nr_1', seq_examples)
-    self.assertEqual(
-        seq_examples['context_nr_1'].feature_lists.feature_list['tensor_name1']
-        .feature[0].int64_list.value, [12, 13, 14])
-    # each context has 2 observations. The reward is scalar, the
-    # 2 features' shapes are given in `create_example` above.
-    expected_ctx_0 = text_format.Parse(
-        """
+# The first context of the example log. Each context has 2 observations. The
+# reward is scalar, the 2 features' shapes are given in `create_example_bytes`
+# above.
+_EXPECTED_CTX_0_TEXT = """
 feature_lists {
   feature_list {
     key: "reward"
@@ -273,17 +276,82 @@ feature_lists {
     }
   }
 }
-""", tf.train.SequenceExample())
-    self.assertProtoEquals(expected_ctx_0, seq_examples['context_nr_0'])
+"""
 
-  def test_errors(self):
-    logfile = self.create_tempfile()
-    for error_marker in LogTestExampleBuilder.ErrorMarkers:
-      if not error_marker:
-        continue
-      create_example(logfile, introduce_errors_pos=error_marker)
-      with self.assertRaises(Exception):
-        log_reader.read_log_as_sequence_examples(logfile)
+_EXPECTED_CTX_0 = text_format.Parse(_EXPECTED_CTX_0_TEXT,
+                                    tf.train.SequenceExample())
+
+
+class LogReaderTest(tf.test.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    # Most tests read the same example logs, so only build them once.
+    cls._default_log = create_example_bytes()
+    cls._two_ctx_log = create_example_bytes(nr_contexts=2)
+
+  def test_create_tensorspec(self):
+    ts = log_reader.create_tensorspec({
+        'name': 'tensor_name',
+        'port': 0,
+        'shape': [2, 3],
+        'type': 'float'
+    })
+    self.assertEqual(
+        ts, tf.TensorSpec(name='tensor_name', shape=[2, 3], dtype=tf.float32))
+
+  def test_read_header(self):
+    with io.BytesIO(self._default_log) as f:
+      header = log_reader._read_header(f)  # pylint: disable=protected-access
+      self.assertIsNotNone(header)
+      # Disable attribute error because header is an Optional type, and pytype
+      # on python 3.9 doesn't recognise that we already checked the Optional is
+      # not None
+      # pytype: disable=attribute-error
+      self.assertEqual(header.features, [
+          tf.TensorSpec(name='tensor_name2', shape=[2, 3], dtype=tf.float32),
+          tf.TensorSpec(name='tensor_name1', shape=[3, 1], dtype=tf.int64)
+      ])
+      self.assertEqual(
+          header.score,
+          tf.TensorSpec(name='reward', shape=[1], dtype=tf.float32))
+      # pytype: enable=attribute-error
+
+  def test_read_header_empty_file(self):
+    with io.BytesIO() as f:
+      header = log_reader._read_header(f)  # pylint:disable=protected-access
+      self.assertIsNone(header)
+
+  def test_read_log(self):
+    logfile = self.create_tempfile(content=self._default_log)
+    obs_id = 0
+    for record in log_reader.read_log(logfile.full_path):
+      self.assertEqual(record.observation_id, obs_id)
+      self.assertAlmostEqual(record.score[0], 1.2 + obs_id)
+      obs_id += 1
+    self.assertEqual(obs_id, 2)
+
+  def test_to_numpy(self):
+    t0_val = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]
+    t1_val = [1, 2, 3]
+    for record in log_reader.read_log_from_file(io.BytesIO(self._default_log)):
+      np.testing.assert_allclose(record.feature_values[0].to_numpy(),
+                                 np.array(t0_val))
+      np.testing.assert_allclose(record.feature_values[1].to_numpy(),
+                                 np.array(t1_val))
+      t0_val = [v + 1 for v in t0_val]
+      t1_val = [v + 1 for v in t1_val]
+
+  def test_seq_example_conversion(self):
+    seq_examples = log_reader.read_log_as_sequence_examples_from_file(
+        io.BytesIO(self._two_ctx_log))
+    self.assertIn('context_nr_0', seq_examples)
+    self.assertIn('context_nr_1', seq_examples)
+    self.assertEqual(
+        seq_examples['context_nr_1'].feature_lists.feature_list['tensor_name1']
+        .feature[0].int64_list.value, [12, 13, 14])
+    self.assertProtoEquals(_EXPECTED_CTX_0, seq_examples['context_nr_0'])
 
   def test_truncated_tensors(self):
     logfile = self.create_tempfile()
@@ -307,10 +375,25 @@ feature_lists {
       writer.write_context_marker('whatever')
       writer.write_observation_marker(0)
       writer.write_buff([1], ctypes.c_int16)
+      writer.flush()
 
     with self.assertRaises(Exception):
       log_reader.read_log_as_sequence_examples(logfile)
 
 
+# A class of its own, so that under --dist=loadscope these cases get scheduled
+# separately from LogReaderTest.
+class LogReaderErrorsTest(parameterized.TestCase):
+
+  @parameterized.named_parameters(
+      *[(error_marker.name, error_marker)
+        for error_marker in LogTestExampleBuilder.ErrorMarkers
+        if error_marker != LogTestExampleBuilder.ErrorMarkers.NONE])
+  def test_errors(self, error_marker):
+    log = create_example_bytes(introduce_errors_pos=error_marker)
+    with self.assertRaises(Exception):
+      log_reader.read_log_as_sequence_examples_from_file(io.BytesIO(log))
+
+
 if __name__ == '__main__':
   tf.test.main()
@@ -0,0 +1,51 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-process stand-in for subprocess.Popen, for tests."""
+
+from collections.abc import Callable
+
+
+class PopenStub:
+  """Mimics the subset of subprocess.Popen used by the code under test.
+
+  Like Popen, the stub is a context manager. The process always appears to be
+  running: `poll()` invokes `on_poll`, if provided, and returns None. `on_exit`,
+  if provided, is invoked when the `with` block is exited, and is where the
+  caller should release any resources the stub's callbacks use.
+  """
+
+  def __init__(self,
+               *,
+               on_poll: Callable[[], None] | None = None,
+               on_exit: Callable[[], None] | None = None):
+    self._on_poll = on_poll
+    self._on_exit = on_exit
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if self._on_exit:
+      self._on_exit()
+
+  def poll(self) -> int | None:
+    if self._on_poll:
+      self._on_poll()
+    return None
+
+  def wait(self, timeout: float | None = None) -> None:
+    del timeout
+
+  def kill(self) -> None:
+    pass
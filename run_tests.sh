@@ -24,4 +24,4 @@ pipenv sync --dev
 # Run tests
 TF_CPP_MIN_LOG_LEVE=3
 PYTHONPATH="${PYTHONPATH}:$(dirname "$0")"
-pipenv run python3 -m pytest
+pipenv run python3 -m pytest -n auto --dist=loadscope